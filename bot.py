@@ -2,15 +2,23 @@ import os
 import logging
 from dotenv import load_dotenv
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup
-from telegram.ext import Updater, CommandHandler, MessageHandler, CallbackQueryHandler, Filters
+from telegram.constants import ChatAction
+from telegram.request import HTTPXRequest
+from apscheduler.jobstores.base import JobLookupError
+from telegram.ext import AIORateLimiter, ApplicationBuilder, CommandHandler, MessageHandler, CallbackQueryHandler, filters
 import asana
-import openai
-import threading
+import httpx
+from openai import AsyncOpenAI
+import asyncio
 import time
-import warnings
-import json
+import orjson
 import re
-import tempfile
+from io import BytesIO
+import hashlib
+import pathlib
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
 
 # Load environment variables
 load_dotenv()
@@ -19,78 +27,350 @@ load_dotenv()
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.WARNING)
 logger = logging.getLogger(__name__)
 
+class TTLLRU:
+    """Dict-like store bounded by size (LRU eviction) and idle time (TTL expiry).
+
+    Reads and writes move an entry to the most-recently-used end and refresh its
+    expiry. Entries for which ``is_locked(value)`` is true are skipped by size
+    eviction so an in-flight flow is never dropped; they still expire by TTL.
+    """
+
+    def __init__(self, maxsize, ttl, is_locked=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._is_locked = is_locked or (lambda value: False)
+        self._od = OrderedDict()  # key: (value, expires_at)
+
+    def _live(self, key):
+        item = self._od.get(key)
+        if item is None:
+            return None
+        if item[1] <= time.monotonic():
+            del self._od[key]
+            return None
+        return item
+
+    def touch(self, key):
+        item = self._live(key)
+        if item is None:
+            return False
+        self._od[key] = (item[0], time.monotonic() + self.ttl)
+        self._od.move_to_end(key)
+        return True
+
+    def peek(self, key, default=None):
+        # Like get, but without refreshing recency or expiry
+        item = self._live(key)
+        return default if item is None else item[0]
+
+    def get(self, key, default=None):
+        if not self.touch(key):
+            return default
+        return self._od[key][0]
+
+    def __getitem__(self, key):
+        if not self.touch(key):
+            raise KeyError(key)
+        return self._od[key][0]
+
+    def __setitem__(self, key, value):
+        self._od[key] = (value, time.monotonic() + self.ttl)
+        self._od.move_to_end(key)
+        if len(self._od) > self.maxsize:
+            self._evict()
+
+    def __delitem__(self, key):
+        del self._od[key]
+
+    def __contains__(self, key):
+        return self._live(key) is not None
+
+    def __len__(self):
+        return len(self._od)
+
+    def pop(self, key, default=None):
+        item = self._live(key)
+        if item is None:
+            return default
+        del self._od[key]
+        return item[0]
+
+    def keys(self):
+        return list(self._od.keys())
+
+    def _evict(self):
+        # Walk from the LRU end without copying the keys, stopping once enough
+        # unlocked victims are found (usually the first entry)
+        excess = len(self._od) - self.maxsize
+        if excess <= 0:
+            return
+        victims = []
+        for key, (value, _) in self._od.items():
+            if not self._is_locked(value):
+                victims.append(key)
+                if len(victims) == excess:
+                    break
+        for key in victims:
+            del self._od[key]
+
+    def expire(self):
+        now = time.monotonic()
+        expired = [key for key, (_, expires_at) in self._od.items() if expires_at <= now]
+        for key in expired:
+            del self._od[key]
+        return len(expired)
+
+@dataclass(slots=True)
+class Batch:
+    # Forwarded messages collected for one user until BATCH_TIMEOUT passes quietly
+    messages: list = field(default_factory=list)
+    last_time: float = 0.0
+    last_message_id: int = 0
+    sender: str = 'Unknown'
+    forward_date_str: str = 'Unknown date'
+    forward_from_chat: dict | None = None
+    user_title: str | None = None
+    documents: list = field(default_factory=list)
+    photos: list = field(default_factory=list)
+    job: object = None  # telegram.ext.Job that flushes the batch
+
+@dataclass(slots=True)
+class PendingTask:
+    # A flushed batch waiting for its title and/or project
+    text: str
+    state: str  # 'awaiting_title', 'awaiting_project' or 'creating'
+    user_id: int
+    sender: str
+    forward_date_str: str
+    forward_from_chat: dict | None
+    documents: list
+    photos: list
+    user_title: str = ''
+    active: bool = True
+
+@dataclass(slots=True)
+class UserLock:
+    # A user's lock plus how many coroutines currently hold or wait on it
+    lock: asyncio.Lock = field(default_factory=asyncio.Lock)
+    users: int = 0
+
 # Initialize clients
 asana_client = asana.Client.access_token(os.getenv('ASANA_PAT'))
 asana_client.options['headers'] = {
     "Asana-Enable": "new_user_task_lists,new_goal_memberships"
 }
-openai.api_key = os.getenv('OPENAI_API_KEY')
+# Pooled HTTP/2 client for Asana REST calls made directly from the event loop
+asana_http = httpx.AsyncClient(
+    base_url="https://app.asana.com/api/1.0",
+    headers={
+        "Authorization": f"Bearer {os.getenv('ASANA_PAT')}",
+        "Asana-Enable": "new_user_task_lists,new_goal_memberships"
+    },
+    http2=True,
+    timeout=15.0,
+    limits=httpx.Limits(max_keepalive_connections=20)
+)
+openai_client = AsyncOpenAI(api_key=os.getenv('OPENAI_API_KEY'))
 
 # Get project configuration
 PROJECT_IDS = os.getenv('ASANA_PROJECT_IDS', '').split(',')
 PROJECT_NAMES = os.getenv('ASANA_PROJECT_NAMES', '').split(',')
+PROJECTS = tuple(
+    (name.strip(), pid.strip())
+    for name, pid in zip(PROJECT_NAMES, PROJECT_IDS)
+    if name.strip() and pid.strip()
+)
+PROJECTS_TEXT = "Your Asana projects:\n" + "\n".join(f"- {name}" for name, _ in PROJECTS)
+
+# The project keyboard is identical for every task; the task it belongs to is
+# looked up from the message the keyboard is attached to (see remember_pending_task)
+# Each row offers immediate creation or queueing the AI pass on the OpenAI Batch API
+PROJECT_MARKUP = InlineKeyboardMarkup(
+    [[InlineKeyboardButton(name, callback_data=f"project_{pid}"),
+      InlineKeyboardButton("🕒 Queue (cheap)", callback_data=f"queue_{pid}")]
+     for name, pid in PROJECTS]
+)
+
+# Model for the AI title/description pass; SYSTEM_PROMPT is sent first and
+# byte-identical on every call so the provider can reuse the cached prefix
+OPENAI_MODEL = os.getenv('OPENAI_MODEL', 'gpt-4o-mini')
+
+# Instructions for the AI title/description pass
+SYSTEM_PROMPT = (
+    "You are an assistant that helps create Asana tasks. "
+    "Given a user-suggested title and the original message, "
+    "make only the most minimal, surface-level corrections to the title (fix typos, grammar, capitalization). "
+    "Do NOT rewrite, rephrase, summarize, or change the wording, meaning, or intent of the title. "
+    "The title should remain as close as possible to the user's original, only fixing obvious errors. "
+    "Also generate a concise description (max 50 words). "
+    "Return both as JSON: {\"title\": ..., \"description\": ...}"
+)
+
+# Telegram @username inside a sender label such as "Jane Doe (@jane)"
+USERNAME_RE = re.compile(r'@(\w+)')
+# Line boundaries str.splitlines() recognizes, lines of a forwarded message
+# that hold only whitespace, and the start of each non-empty line
+LINE_BREAK_RE = re.compile('\r\n|[\n\r\v\f\x1c\x1d\x1e\x85\u2028\u2029]')
+BLANK_LINE_RE = re.compile(r'^[^\S\n]+$', re.M)
+LINE_START_RE = re.compile(r'^(?=.)', re.M)
+
+# Layout of the Asana task notes; adjacent literals are joined at compile time
+TASK_NOTES_TEMPLATE = (
+    "CONTEXT: \n{description}\n\n"
+    "------------------------------\n"
+    "ORIGINAL TG MESSAGE: \n{message}\n"
+    "------------------------------\n"
+    "FORWARDED FROM: {forwarded_from}\n"
+    "------------------------------"
+)
+
+# Main menu buttons
+MENU_CREATE_TASK = "📋 Create Asana Task"
+MENU_PROJECTS = "🗂 My Asana Projects"
+MENU_HELP = "❓ Help"
+MENU_ABOUT = "ℹ️ About"
+MENU_REPLIES = {
+    MENU_CREATE_TASK: "Just forward one or more messages to me to start creating an Asana task!",
+    MENU_PROJECTS: PROJECTS_TEXT,
+    MENU_HELP: "Forward messages to create tasks. After forwarding, reply with a title, then pick a project. The bot will use AI to help format your task!",
+    MENU_ABOUT: "Telegram-Asana Bot by RCR. Integrates Telegram with Asana using AI for smart task creation."
+}
 
 # Store forwarded messages and state temporarily
-message_store = {}  # message_id: {'text': ..., 'state': ..., 'user_id': ...}
+message_store = TTLLRU(
+    maxsize=10_000,
+    ttl=3600,
+    is_locked=lambda entry: entry.state in ('awaiting_project', 'creating')
+)  # (chat_id, message_id): PendingTask; message ids are only unique within a chat
+STORE_SWEEP_INTERVAL = 300  # seconds
+
+# Cache AI title/description results so retries don't repeat the OpenAI call
+ai_cache = TTLLRU(maxsize=512, ttl=3600)  # (user_title, original_text): (title, description)
+
+# Last text the bot put on each callback message, to skip no-op edits
+last_edits = TTLLRU(maxsize=1000, ttl=3600)  # (chat_id, message_id): text
+
+# Resolved Telegram files, so retrying a task doesn't repeat get_file calls;
+# download links stay valid for at least an hour, so entries expire 30 minutes
+# after resolving no matter how often they are read (peek, never get)
+file_cache = TTLLRU(maxsize=256, ttl=1800)  # file_id: telegram.File
+
+# Tasks waiting for the next OpenAI Batch API submission, and submitted batches
+queued_tasks = []  # [{'custom_id': ..., 'store': ..., 'project_id': ..., 'chat_id': ..., 'message_id': ...}]
+ai_batches = {}  # batch_id: {custom_id: queued task}
+AI_BATCH_POLL_INTERVAL = 60  # seconds
 
 # Store batches of forwarded messages per user
-batch_store = {}  # user_id: {'messages': [str], 'timer': threading.Timer, 'last_time': float, 'last_message_id': int}
+batch_store = {}  # user_id: Batch
 BATCH_TIMEOUT = 2  # seconds
+TELEGRAM_DOWNLOAD_LIMIT = 20 * 1024 * 1024  # bytes; bots can't download larger files
+
+# Serialize each user's updates (forwards, titles, project clicks) while
+# different users are handled concurrently
+user_locks = {}  # user_id: UserLock
 
 # Store recent prompt message IDs per user for flexible reply handling
-recent_prompts = {}  # user_id: [prompt_message_id]
+recent_prompts = TTLLRU(maxsize=10_000, ttl=3600)  # user_id: OrderedDict[(chat_id, prompt_message_id), None], oldest first
 MAX_RECENT_PROMPTS = 5
 
 # Store the last text message per user for caption/title detection
-last_text_message = {}  # user_id: {'text': ..., 'timestamp': ...}
+TITLE_WINDOW = 60  # seconds a preceding text message counts as the title
+last_text_message = TTLLRU(maxsize=10_000, ttl=TITLE_WINDOW)  # user_id: {'text': ..., 'timestamp': ...}
+
+def remember_pending_task(context, keyboard_key, task_key):
+    # Map the project keyboard message to its message_store entry, both as
+    # (chat_id, message_id); only the most recent prompts per user stay selectable
+    pending = context.user_data.setdefault('pending_tasks', {})
+    pending[keyboard_key] = task_key
+    while len(pending) > MAX_RECENT_PROMPTS:
+        pending.pop(next(iter(pending)))
+
+@asynccontextmanager
+async def user_lock(user_id):
+    entry = user_locks.get(user_id)
+    if entry is None:
+        entry = user_locks[user_id] = UserLock()
+    # Count waiters too: Lock.locked() is False while a woken waiter has yet to
+    # take the lock, so it can't tell whether the lock is safe to drop
+    entry.users += 1
+    try:
+        async with entry.lock:
+            yield
+    finally:
+        entry.users -= 1
+
+def release_user_lock(user_id):
+    # Drop the lock of a user whose flow has finished, unless it is in use
+    entry = user_locks.get(user_id)
+    if entry is not None and not entry.users:
+        del user_locks[user_id]
 
-warnings.filterwarnings("ignore", message="python-telegram-bot is using upstream urllib3")
+def prune_user_locks():
+    # Drop locks nobody holds or waits on, e.g. from abandoned or expired flows
+    idle = [user_id for user_id, entry in user_locks.items() if not entry.users]
+    for user_id in idle:
+        del user_locks[user_id]
+    return len(idle)
 
-def log_all_messages(update: Update, context):
-    logger.info(f"RAW MESSAGE: {update.message}")
-    # Track last text message for each user
-    if update.message.text and not update.message.forward_from and not update.message.forward_from_chat:
+async def edit_query_message(query, text, reply_markup=None):
+    # An identical edit costs a Bot API call only to fail with "Message is not modified";
+    # message ids are only unique within a chat
+    key = (query.message.chat_id, query.message.message_id)
+    if reply_markup is None and (text == query.message.text or last_edits.get(key) == text):
+        return
+    await query.edit_message_text(text, reply_markup=reply_markup)
+    last_edits[key] = text
+
+async def sweep_stores(context):
+    expired = (
+        message_store.expire() + ai_cache.expire() + last_edits.expire() + file_cache.expire()
+        + recent_prompts.expire() + last_text_message.expire()
+    )
+    if expired:
+        logger.info("Expired %s stale store entries", expired)
+    pruned = prune_user_locks()
+    if pruned:
+        logger.info("Dropped %s idle user locks", pruned)
+
+async def log_all_messages(update: Update, context):
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("RAW MESSAGE: %s", update.message)
+    # Track last text message for each user; menu taps aren't titles
+    text = update.message.text
+    if text and text not in MENU_REPLIES and not update.message.forward_from and not update.message.forward_from_chat:
         user_id = update.message.from_user.id
         last_text_message[user_id] = {
-            'text': update.message.text.strip(),
+            'text': text.strip(),
             'timestamp': time.time()
         }
 
-def start(update: Update, context):
-    print("Start handler called")
+async def start(update: Update, context):
     try:
-        update.message.reply_text('👋 Hi! Forward any message to me and I\'ll help you create an Asana task!')
+        await update.message.reply_text('👋 Hi! Forward any message to me and I\'ll help you create an Asana task!')
     except Exception as e:
-        print("Error sending reply:", e)
+        logger.error("Error sending start reply: %s", e)
 
-def help_command(update: Update, context):
-    update.message.reply_text('📝 How to use:\n1. Forward a message\n2. Select project\n3. Get task link!')
+async def help_command(update: Update, context):
+    await update.message.reply_text('📝 How to use:\n1. Forward a message\n2. Select project\n3. Get task link!')
 
-def menu(update: Update, context):
+async def menu(update: Update, context):
     keyboard = [
-        ["📋 Create Asana Task", "🗂 My Asana Projects"],
-        ["❓ Help", "ℹ️ About"]
+        [MENU_CREATE_TASK, MENU_PROJECTS],
+        [MENU_HELP, MENU_ABOUT]
     ]
     reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True, one_time_keyboard=True)
-    update.message.reply_text(
+    await update.message.reply_text(
         "Please choose an option:",
         reply_markup=reply_markup
     )
 
-def handle_menu_option(update: Update, context):
-    text = update.message.text
-    if text == "📋 Create Asana Task":
-        update.message.reply_text("Just forward one or more messages to me to start creating an Asana task!")
-    elif text == "🗂 My Asana Projects":
-        projects = '\n'.join([f"- {name}" for name in PROJECT_NAMES if name])
-        update.message.reply_text(f"Your Asana projects:\n{projects}")
-    elif text == "❓ Help":
-        update.message.reply_text("Forward messages to create tasks. After forwarding, reply with a title, then pick a project. The bot will use AI to help format your task!")
-    elif text == "ℹ️ About":
-        update.message.reply_text("Telegram-Asana Bot by RCR. Integrates Telegram with Asana using AI for smart task creation.")
-
-def handle_forwarded_message(update: Update, context):
-    print("handle_forwarded_message called")
+async def handle_menu_option(update: Update, context):
+    reply = MENU_REPLIES.get(update.message.text)
+    if reply is None:
+        return
+    await update.message.reply_text(reply)
+
+async def handle_forwarded_message(update: Update, context):
     is_forwarded = bool(
         getattr(update.message, 'forward_from', None) or 
         getattr(update.message, 'forward_from_chat', None) or 
@@ -99,9 +379,9 @@ def handle_forwarded_message(update: Update, context):
     if not is_forwarded:
         logger.warning("Message is not forwarded (no forward_from, forward_from_chat, or forward_date).")
         try:
-            update.message.reply_text("Please forward a message to create a task.")
+            await update.message.reply_text("Please forward a message to create a task.")
         except Exception as e:
-            logger.error(f"Error sending not-forwarded reply: {e}")
+            logger.error("Error sending not-forwarded reply: %s", e)
         return
     user_id = update.message.from_user.id
     message_text = update.message.text or update.message.caption or ""
@@ -117,25 +397,29 @@ def handle_forwarded_message(update: Update, context):
         }
     # Handle photo (image) attachments
     if update.message.photo:
-        # Get the highest resolution photo
-        photo = update.message.photo[-1]
-        file_id = photo.file_id
-        file_unique_id = photo.file_unique_id
-        # Use a generic filename if none is provided
-        file_name = f"photo_{file_unique_id}.jpg"
-        photo_info = {
-            'file_id': file_id,
-            'file_name': file_name,
-            'mime_type': 'image/jpeg',
-            'file_size': photo.file_size if hasattr(photo, 'file_size') else None
-        }
+        # Get the highest resolution photo the bot can download; don't rely on the order of sizes
+        photo = max(
+            (p for p in update.message.photo if (p.file_size or 0) <= TELEGRAM_DOWNLOAD_LIMIT),
+            key=lambda p: p.file_size or 0,
+            default=None
+        )
+        if photo is None:
+            logger.warning("Skipping photo: every size is over the bot download limit")
+        else:
+            photo_info = {
+                'file_id': photo.file_id,
+                # Use a generic filename since photos don't carry one
+                'file_name': f"photo_{photo.file_unique_id}.jpg",
+                'mime_type': 'image/jpeg',
+                'file_size': photo.file_size
+            }
     # If no text/caption but there is a document or photo, treat as valid
     if not message_text and not document_info and not photo_info:
         logger.warning("Forwarded message has no text, caption, document, or photo.")
         try:
-            update.message.reply_text("Please forward a text message or a media message with a caption.")
+            await update.message.reply_text("Please forward a text message or a media message with a caption.")
         except Exception as e:
-            logger.error(f"Error sending no-text reply: {e}")
+            logger.error("Error sending no-text reply: %s", e)
         return
     # If only document or photo, use filename as placeholder text
     if not message_text and document_info:
@@ -168,198 +452,269 @@ def handle_forwarded_message(update: Update, context):
     now = time.time()
     use_caption = False
     user_title = None
-    if user_last_text and (now - user_last_text['timestamp'] <= 60):  # 60s window for robustness
+    if user_last_text and (now - user_last_text['timestamp'] <= TITLE_WINDOW):
         use_caption = True
         user_title = user_last_text['text']
-    logger.info(f"Batching for user {user_id}: {message_text}")
-    if user_id in batch_store:
-        batch_store[user_id]['messages'].append(message_text)
-        batch_store[user_id]['last_time'] = now
-        batch_store[user_id]['last_message_id'] = update.message.message_id
-        batch_store[user_id]['timer'].cancel()
-        batch_store[user_id]['sender'] = sender
-        batch_store[user_id]['forward_date_str'] = forward_date_str
-        batch_store[user_id]['forward_from_chat'] = forward_from_chat_info
-        batch_store[user_id]['user_title'] = user_title if use_caption else None
-        # Store document info if present
+    logger.info("Batching for user %s: %s", user_id, message_text)
+    # Appending to the batch and rescheduling its flush happen atomically per user
+    async with user_lock(user_id):
+        batch = batch_store.get(user_id)
+        if batch is None:
+            batch = batch_store[user_id] = Batch()
+        batch.messages.append(message_text)
+        batch.last_time = now
+        batch.last_message_id = update.message.message_id
+        batch.sender = sender
+        batch.forward_date_str = forward_date_str
+        batch.forward_from_chat = forward_from_chat_info
+        batch.user_title = user_title if use_caption else None
+        # Store document and photo info if present
         if document_info:
-            if 'documents' not in batch_store[user_id]:
-                batch_store[user_id]['documents'] = []
-            batch_store[user_id]['documents'].append(document_info)
-        # Store photo info if present
+            batch.documents.append(document_info)
         if photo_info:
-            if 'photos' not in batch_store[user_id]:
-                batch_store[user_id]['photos'] = []
-            batch_store[user_id]['photos'].append(photo_info)
-    else:
-        batch_store[user_id] = {
-            'messages': [message_text],
-            'last_time': now,
-            'last_message_id': update.message.message_id,
-            'timer': None,
-            'sender': sender,
-            'forward_date_str': forward_date_str,
-            'forward_from_chat': forward_from_chat_info,
-            'user_title': user_title if use_caption else None,
-            'documents': [document_info] if document_info else [],
-            'photos': [photo_info] if photo_info else []
-        }
-    timer = threading.Timer(BATCH_TIMEOUT, prompt_for_title_or_use_caption, args=(update, context, user_id))
-    batch_store[user_id]['timer'] = timer
-    timer.start()
-
-def prompt_for_title_or_use_caption(update, context, user_id):
-    batch = batch_store.get(user_id)
-    if not batch:
-        return
-    all_text = '\n'.join(batch['messages'])
-    sender = batch.get('sender', 'Unknown')
-    forward_date_str = batch.get('forward_date_str', 'Unknown date')
-    forward_from_chat = batch.get('forward_from_chat', None)
-    user_title = batch.get('user_title', None)
-    documents = batch.get('documents', [])
-    photos = batch.get('photos', [])
-    if user_title:
-        # Store in message_store and go straight to project selection
-        last_message_id = batch['last_message_id']
-        message_store[last_message_id] = {
-            'text': all_text,
-            'user_title': user_title,
-            'state': 'awaiting_project',
-            'user_id': user_id,
-            'active': True,
-            'sender': sender,
-            'forward_date_str': forward_date_str,
-            'forward_from_chat': forward_from_chat,
-            'documents': documents,
-            'photos': photos
-        }
-        keyboard = [[InlineKeyboardButton(name, callback_data=f"project_{pid}:{last_message_id}")]
-                    for name, pid in zip(PROJECT_NAMES, PROJECT_IDS)]
-        context.bot.send_message(
+            batch.photos.append(photo_info)
+        # Push the flush back by cancelling this batch's job directly rather than
+        # scanning every scheduled job by name
+        if batch.job is not None:
+            try:
+                batch.job.schedule_removal()
+            except JobLookupError:
+                pass  # Already fired; it sees it was replaced and skips the flush
+        batch.job = context.job_queue.run_once(
+            prompt_for_title_or_use_caption,
+            BATCH_TIMEOUT,
             chat_id=update.effective_chat.id,
-            text=f"📋 Using your previous message as the title:\n*{user_title}*\n\nWhich Asana project should I add this task to?",
-            reply_markup=InlineKeyboardMarkup(keyboard)
+            user_id=user_id,
+            name=f"batch:{user_id}"
         )
-    else:
-        # Prompt for title as before
-        sent = context.bot.send_message(
-            chat_id=update.effective_chat.id,
-            text="What should the title of the Asana task be?\n(Reply to this message with your title.)"
+
+async def prompt_for_title_or_use_caption(context):
+    user_id = context.job.user_id
+    chat_id = context.job.chat_id
+    async with user_lock(user_id):
+        batch = batch_store.get(user_id)
+        # Only the batch's latest job flushes it; a job that fired while a new
+        # forward was rescheduling it leaves the batch to its replacement
+        if batch is None or batch.job is not context.job:
+            return
+        del batch_store[user_id]
+        pending_task = PendingTask(
+            text='\n'.join(batch.messages),
+            state='awaiting_title',
+            user_id=user_id,
+            sender=batch.sender,
+            forward_date_str=batch.forward_date_str,
+            forward_from_chat=batch.forward_from_chat,
+            documents=batch.documents,
+            photos=batch.photos
         )
-        message_store[sent.message_id] = {
-            'text': all_text,
-            'state': 'awaiting_title',
-            'user_id': user_id,
-            'active': True,
-            'sender': sender,
-            'forward_date_str': forward_date_str,
-            'forward_from_chat': forward_from_chat,
-            'documents': documents,
-            'photos': photos
-        }
-        if user_id not in recent_prompts:
-            recent_prompts[user_id] = []
-        recent_prompts[user_id].append(sent.message_id)
-        if len(recent_prompts[user_id]) > MAX_RECENT_PROMPTS:
-            recent_prompts[user_id] = recent_prompts[user_id][-MAX_RECENT_PROMPTS:]
-    del batch_store[user_id]
-    logger.info(f"Prompted user {user_id} for title or used caption. Caption used: {user_title is not None}")
-
-def handle_title_reply(update: Update, context):
-    logger.info(f"handle_title_reply called. Message: {update.message}")
-    if not update.message.reply_to_message:
-        logger.warning("No reply_to_message in title reply.")
+        user_title = batch.user_title
+        if user_title:
+            # Store in message_store and go straight to project selection
+            task_key = (chat_id, batch.last_message_id)
+            pending_task.user_title = user_title
+            pending_task.state = 'awaiting_project'
+            message_store[task_key] = pending_task
+            sent = await context.bot.send_message(
+                chat_id=chat_id,
+                text=f"📋 Using your previous message as the title:\n*{user_title}*\n\nWhich Asana project should I add this task to?",
+                reply_markup=PROJECT_MARKUP
+            )
+            remember_pending_task(context, (chat_id, sent.message_id), task_key)
+        else:
+            # Prompt for title as before
+            sent = await context.bot.send_message(
+                chat_id=chat_id,
+                text="What should the title of the Asana task be?\n(Reply to this message with your title.)"
+            )
+            task_key = (chat_id, sent.message_id)
+            message_store[task_key] = pending_task
+            prompts = recent_prompts.get(user_id)
+            if prompts is None:
+                prompts = recent_prompts[user_id] = OrderedDict()
+            prompts[task_key] = None
+            prompts.move_to_end(task_key)
+            if len(prompts) > MAX_RECENT_PROMPTS:
+                prompts.popitem(last=False)
+        logger.info("Prompted user %s for title or used caption. Caption used: %s", user_id, user_title is not None)
+
+async def advance_to_project(update: Update, context, task_key):
+    # Record the title on a prompt awaiting one and ask for the project;
+    # returns the title, or None if the prompt can't take a title
+    user_id = update.message.from_user.id
+    entry = message_store.get(task_key)
+    if entry is None:
+        return None
+    if entry.user_id != user_id:
+        logger.warning("User ID mismatch: %s != %s", entry.user_id, user_id)
+        return None
+    if entry.state != 'awaiting_title':
+        logger.warning("State is not 'awaiting_title': %s", entry.state)
+        return None
+    user_title = update.message.text.strip()
+    entry.user_title = user_title
+    entry.state = 'awaiting_project'
+    # Ask for project selection
+    sent = await update.message.reply_text(
+        "📋 Which Asana project should I add this task to?",
+        reply_markup=PROJECT_MARKUP
+    )
+    remember_pending_task(context, (update.message.chat_id, sent.message_id), task_key)
+    return user_title
+
+async def handle_text(update: Update, context):
+    # Single entry point for plain text: menu buttons, replies to a title
+    # prompt, or a standalone title
+    if update.message.text in MENU_REPLIES:
+        await handle_menu_option(update, context)
         return
+    async with user_lock(update.message.from_user.id):
+        if update.message.reply_to_message:
+            await handle_title_reply(update, context)
+        else:
+            await handle_title_standalone(update, context)
+
+async def handle_title_reply(update: Update, context):
+    logger.info("handle_title_reply called. Message: %s", update.message)
     replied_id = update.message.reply_to_message.message_id
     user_id = update.message.from_user.id
-    logger.info(f"Replying to message_id: {replied_id}, user_id: {user_id}")
+    logger.info("Replying to message_id: %s, user_id: %s", replied_id, user_id)
+    task_key = (update.message.chat_id, replied_id)
     # Accept reply to any recent prompt for this user
-    valid_prompt = False
-    for pid in recent_prompts.get(user_id, []):
-        if replied_id == pid:
-            valid_prompt = True
-            break
-    if not valid_prompt:
-        logger.warning(f"replied_id {replied_id} not in recent prompts for user {user_id}. Prompts: {recent_prompts.get(user_id, [])}")
-        update.message.reply_text("This prompt is no longer active. Please forward new messages to create a new task.")
-        return
-    if replied_id not in message_store:
-        logger.warning(f"replied_id {replied_id} not in message_store. Keys: {list(message_store.keys())}")
-        update.message.reply_text("This prompt has expired. Please forward new messages to create a new task.")
-        return
-    if not message_store[replied_id].get('active', True):
-        update.message.reply_text("This task has already been processed. Please forward new messages to create a new task.")
+    prompts = recent_prompts.get(user_id, ())
+    if task_key not in prompts:
+        logger.warning("replied_id %s not in recent prompts for user %s. Prompts: %s", replied_id, user_id, list(prompts))
+        await update.message.reply_text("This prompt is no longer active. Please forward new messages to create a new task.")
         return
-    if message_store[replied_id].get('user_id') != user_id:
-        logger.warning(f"User ID mismatch: {message_store[replied_id].get('user_id')} != {user_id}")
+    if task_key not in message_store:
+        logger.warning("replied_id %s not in message_store. Keys: %s", replied_id, list(message_store.keys()))
+        await update.message.reply_text("This prompt has expired. Please forward new messages to create a new task.")
         return
-    if message_store[replied_id]['state'] != 'awaiting_title':
-        logger.warning(f"State is not 'awaiting_title': {message_store[replied_id]['state']}")
+    if not message_store[task_key].active:
+        await update.message.reply_text("This task has already been processed. Please forward new messages to create a new task.")
         return
-    user_title = update.message.text.strip()
-    original_text = message_store[replied_id]['text']
-    message_store[replied_id]['user_title'] = user_title
-    message_store[replied_id]['state'] = 'awaiting_project'
-    # Ask for project selection
-    keyboard = [[InlineKeyboardButton(name, callback_data=f"project_{pid}:{replied_id}")]
-                for name, pid in zip(PROJECT_NAMES, PROJECT_IDS)]
-    update.message.reply_text(
-        "📋 Which Asana project should I add this task to?",
-        reply_markup=InlineKeyboardMarkup(keyboard)
-    )
-    logger.info(f"Prompted user {user_id} for project selection. Title: {user_title}")
+    user_title = await advance_to_project(update, context, task_key)
+    if user_title is not None:
+        logger.info("Prompted user %s for project selection. Title: %s", user_id, user_title)
 
-def handle_title_standalone(update: Update, context):
+async def handle_title_standalone(update: Update, context):
     user_id = update.message.from_user.id
     # Only proceed if there is exactly one active prompt for this user
-    active_prompts = [pid for pid in recent_prompts.get(user_id, []) if message_store.get(pid, {}).get('active', False)]
+    prompts = recent_prompts.peek(user_id)
+    if not prompts:
+        return
+    # peek so that ordinary chat text doesn't keep stale prompts from expiring
+    active_prompts = [key for key in prompts if getattr(message_store.peek(key), 'active', False)]
     if len(active_prompts) != 1:
         return  # Ignore if not exactly one active prompt
-    replied_id = active_prompts[0]
-    logger.info(f"handle_title_standalone: Using active prompt {replied_id} for user {user_id}")
-    if replied_id not in message_store:
-        return
-    if message_store[replied_id].get('user_id') != user_id:
-        return
-    if message_store[replied_id]['state'] != 'awaiting_title':
-        return
-    user_title = update.message.text.strip()
-    original_text = message_store[replied_id]['text']
-    message_store[replied_id]['user_title'] = user_title
-    message_store[replied_id]['state'] = 'awaiting_project'
-    # Ask for project selection
-    keyboard = [[InlineKeyboardButton(name, callback_data=f"project_{pid}:{replied_id}")]
-                for name, pid in zip(PROJECT_NAMES, PROJECT_IDS)]
-    update.message.reply_text(
-        "📋 Which Asana project should I add this task to?",
-        reply_markup=InlineKeyboardMarkup(keyboard)
-    )
-    logger.info(f"Prompted user {user_id} for project selection (standalone title). Title: {user_title}")
+    task_key = active_prompts[0]
+    logger.info("handle_title_standalone: Using active prompt %s for user %s", task_key, user_id)
+    user_title = await advance_to_project(update, context, task_key)
+    if user_title is not None:
+        logger.info("Prompted user %s for project selection (standalone title). Title: %s", user_id, user_title)
+
+def strip_code_fence(text):
+    # Models sometimes wrap JSON in a ```json fence; orjson needs the bare object
+    return text.strip().removeprefix('```json').removeprefix('```').removesuffix('```').strip()
+
+def ai_request_body(user_title, original_text):
+    # Chat completion parameters shared by the realtime and Batch API paths
+    return {
+        'model': OPENAI_MODEL,
+        'messages': [
+            {"role": "system", "content": SYSTEM_PROMPT},
+            {"role": "user", "content": f"User title: {user_title}\nOriginal message: {original_text}"}
+        ],
+        # JSON mode guarantees a parseable object; leave room for a title and a
+        # 50-word description so the object isn't cut off
+        'response_format': {"type": "json_object"},
+        'max_tokens': 150
+    }
+
+async def improve_task_text(user_title, original_text):
+    # Returns (improved_title, improved_description); repeated clicks and
+    # retries for the same title and text are served from ai_cache
+    cache_key = (user_title, original_text)
+    cached = ai_cache.get(cache_key)
+    if cached is not None:
+        return cached
+    stream = await openai_client.chat.completions.create(**ai_request_body(user_title, original_text), stream=True)
+    # Stop reading as soon as the JSON object is complete so the Asana call can
+    # start without waiting for the tail of the stream
+    ai_result = ''
+    ai_json = None
+    try:
+        async for chunk in stream:
+            if not chunk.choices:
+                continue
+            ai_result += chunk.choices[0].delta.content or ''
+            candidate = strip_code_fence(ai_result)
+            if not candidate.endswith('}'):
+                continue
+            try:
+                ai_json = orjson.loads(candidate)
+            except orjson.JSONDecodeError:
+                continue
+            break
+    finally:
+        await stream.response.aclose()
+    logger.warning("OpenAI raw response: %s", ai_result)
+    if not isinstance(ai_json, dict):
+        raise ValueError(f"OpenAI response is not a complete JSON object: {ai_result!r}")
+    result = (ai_json.get('title', user_title), ai_json.get('description', ''))
+    ai_cache[cache_key] = result
+    return result
 
-def button_callback(update: Update, context):
+async def button_callback(update: Update, context):
     query = update.callback_query
-    query.answer()
     try:
-        project_part, original_message_id = query.data.split(":")
-        project_id = project_part.split("_")[1]
-        original_message_id = int(original_message_id)
+        action, project_id = query.data.split("_", 1)
+        if action not in ('project', 'queue'):
+            raise ValueError(f"unknown action {action!r}")
     except Exception as e:
-        logger.error(f"Error parsing callback data: {e}")
-        query.edit_message_text("Error: Invalid callback data.")
-        return
-    store = message_store.get(original_message_id)
-    if not store:
-        query.edit_message_text("Error: Message not found.")
+        logger.error("Error parsing callback data: %s", e)
+        await query.answer()
+        await edit_query_message(query, "Error: Invalid callback data.")
         return
-    if not store.get('active', True):
-        query.edit_message_text("This task has already been processed. Please forward new messages to create a new task.")
+    pending_tasks = context.user_data.get('pending_tasks', {})
+    keyboard_key = (query.message.chat_id, query.message.message_id)
+    task_key = pending_tasks.get(keyboard_key)
+    # Claim the task under the user's lock, but don't hold the lock across the
+    # slow OpenAI/Asana calls in finish_task
+    async with user_lock(query.from_user.id):
+        store = message_store.get(task_key)
+        if not store:
+            await query.answer()
+            await edit_query_message(query, "Error: Message not found.")
+            return
+        if store.user_id != query.from_user.id:
+            logger.warning("User ID mismatch: %s != %s", store.user_id, query.from_user.id)
+            await query.answer(text="This task belongs to someone else.")
+            return
+        if not store.active:
+            await query.answer()
+            await edit_query_message(query, "This task has already been processed. Please forward new messages to create a new task.")
+            return
+        if store.state == 'creating':
+            await query.answer(text="This task is already being created.")
+            return
+        store.state = 'creating'
+    if action == 'queue':
+        await queue_task(query, store, project_id, task_key, pending_tasks)
         return
-    user_title = store.get('user_title', '')
-    original_text = store.get('text', '')
-    sender = store.get('sender', 'Unknown')
-    forward_date_str = store.get('forward_date_str', 'Unknown date')
-    forward_from_chat = store.get('forward_from_chat', None)
+    # Acknowledge right away and run the slow part as a tracked background task,
+    # so the callback handler returns immediately
+    await query.answer(text="Creating task…")
+    context.application.create_task(
+        finish_task(context.bot, query, store, project_id, task_key, pending_tasks),
+        update=update
+    )
+
+def compose_task_notes(store, improved_description):
+    original_text = store.text
+    sender = store.sender
+    forward_date_str = store.forward_date_str
+    forward_from_chat = store.forward_from_chat
     # Try to extract group/channel info for link
     group_name = None
     group_link = None
@@ -370,14 +725,21 @@ def button_callback(update: Update, context):
     # Parse each line to add username prefix
     username_prefix = ''
     if sender and sender != 'Unknown':
-        m = re.search(r'@([\w_]+)', sender)
+        m = USERNAME_RE.search(sender)
         if m:
             username_prefix = f"@{m.group(1)}: "
         else:
             username_prefix = f"{sender}: "
     else:
         username_prefix = ''
-    indented_message = '\n'.join([f'{username_prefix}{line}' if line.strip() else '' for line in original_text.splitlines()])
+    # Same result as joining splitlines() with blanked whitespace-only lines and
+    # prefixed non-empty ones, without a Python-level loop
+    indented_message = LINE_BREAK_RE.sub('\n', original_text)
+    if indented_message.endswith('\n'):
+        indented_message = indented_message[:-1]  # splitlines() drops only the final break
+    indented_message = BLANK_LINE_RE.sub('', indented_message)
+    if username_prefix:
+        indented_message = LINE_START_RE.sub(username_prefix.replace('\\', '\\\\'), indented_message)
     # Compose FORWARDED FROM section
     if group_name:
         if group_link:
@@ -386,146 +748,293 @@ def button_callback(update: Update, context):
             forwarded_from_str = f"{group_name} on {forward_date_str}"
     else:
         forwarded_from_str = f"{sender} on {forward_date_str}"
-    # Remove the per-line username note from the description
+    return TASK_NOTES_TEMPLATE.format(
+        description=improved_description,
+        message=indented_message,
+        forwarded_from=forwarded_from_str
+    )
+
+MAX_PARALLEL_UPLOADS = 8
+
+async def resolve_file(bot, file_id):
+    tg_file = file_cache.peek(file_id)
+    if tg_file is None:
+        tg_file = await bot.get_file(file_id)
+        file_cache[file_id] = tg_file
+    return tg_file
+
+async def upload_attachment(bot, task_gid, attachment):
+    # Attachments are within Telegram's 20 MB bot download limit, so buffer
+    # them in memory instead of round-tripping through a temp file
+    tg_file = await resolve_file(bot, attachment['file_id'])
+    buf = BytesIO()
+    await tg_file.download_to_memory(out=buf)
+    buf.seek(0)
+    await asyncio.to_thread(
+        asana_client.attachments.create_on_task,
+        task_gid,
+        file_content=buf,
+        file_name=attachment['file_name'],
+        file_content_type=attachment['mime_type']
+    )
+
+async def create_asana_task(bot, store, project_id, improved_title, improved_description):
+    # Create the task with its notes and attachments; returns the task URL
+    # Only the gid is used, so don't have Asana serialize the full task back
+    response = await asana_http.post(
+        '/tasks',
+        params={'opt_fields': 'gid'},
+        content=orjson.dumps({'data': {
+            'name': improved_title,
+            'notes': compose_task_notes(store, improved_description),
+            'projects': [project_id]
+        }}),
+        headers={'Content-Type': 'application/json'}
+    )
+    response.raise_for_status()
+    task = orjson.loads(response.content)['data']
+    # Upload all documents and photos as attachments concurrently, a few at a time
+    attachments = store.documents + store.photos
+    upload_slots = asyncio.Semaphore(MAX_PARALLEL_UPLOADS)
+
+    async def upload(attachment):
+        async with upload_slots:
+            await upload_attachment(bot, task['gid'], attachment)
+
+    results = await asyncio.gather(*(upload(attachment) for attachment in attachments), return_exceptions=True)
+    for attachment, result in zip(attachments, results):
+        if isinstance(result, Exception):
+            logger.error("Failed to upload attachment %s to Asana: %s", attachment['file_name'], result)
+    return f"https://app.asana.com/0/{project_id}/{task['gid']}"
+
+async def close_task_flow(store, task_key, pending_tasks, keyboard_key):
+    # The flow is done with message_store; drop its per-user bookkeeping
+    user_id = store.user_id
+    async with user_lock(user_id):
+        store.active = False
+        if user_id in recent_prompts:
+            recent_prompts[user_id].pop(task_key, None)
+        message_store.pop(task_key, None)
+        pending_tasks.pop(keyboard_key, None)
+    release_user_lock(user_id)
+
+async def queue_task(query, store, project_id, task_key, pending_tasks):
+    # Hand the AI pass to the next Batch API submission; the queued entry keeps
+    # its own reference to the task data since the batch can take up to 24h
+    custom_id = f"{store.user_id}:{task_key[0]}:{task_key[1]}"
+    queued_tasks.append({
+        'custom_id': custom_id,
+        'store': store,
+        'project_id': project_id,
+        'chat_id': query.message.chat_id,
+        'message_id': query.message.message_id
+    })
+    await query.answer(text="Queued")
+    await edit_query_message(query, "🕒 Queued for batch processing. I'll update this message with the task link when it's ready (this can take up to 24 hours).")
+    await close_task_flow(store, task_key, pending_tasks, (query.message.chat_id, query.message.message_id))
+    logger.info("Queued task %s for the OpenAI Batch API", custom_id)
+
+async def report_batched_task(bot, entry, text):
     try:
-        response = openai.ChatCompletion.create(
-            model="gpt-3.5-turbo",
-            messages=[
-                {"role": "system", "content": (
-                    "You are an assistant that helps create Asana tasks. "
-                    "Given a user-suggested title and the original message, "
-                    "make only the most minimal, surface-level corrections to the title (fix typos, grammar, capitalization). "
-                    "Do NOT rewrite, rephrase, summarize, or change the wording, meaning, or intent of the title. "
-                    "The title should remain as close as possible to the user's original, only fixing obvious errors. "
-                    "Also generate a concise description (max 50 words). "
-                    "Return both as JSON: {\"title\": ..., \"description\": ...}"
-                )},
-                {"role": "user", "content": f"User title: {user_title}\nOriginal message: {original_text}"}
-            ],
-            max_tokens=100
+        await bot.edit_message_text(text, chat_id=entry['chat_id'], message_id=entry['message_id'])
+    except Exception as e:
+        logger.error("Could not update queued task message %s: %s", entry['custom_id'], e)
+
+async def process_ai_batches(context):
+    # Submit queued AI requests as one Batch API job, then create the Asana
+    # tasks for any batches that have finished
+    if queued_tasks:
+        entries = list(queued_tasks)
+        lines = b'\n'.join(
+            orjson.dumps({
+                'custom_id': entry['custom_id'],
+                'method': 'POST',
+                'url': '/v1/chat/completions',
+                'body': ai_request_body(entry['store'].user_title, entry['store'].text)
+            })
+            for entry in entries
         )
-        ai_result = response.choices[0].message['content'].strip()
-        logger.warning(f"OpenAI raw response: {ai_result}")
         try:
-            ai_json = json.loads(ai_result)
-            improved_title = ai_json.get('title', user_title)
-            improved_description = ai_json.get('description', '')
-        except Exception:
-            improved_title = user_title
-            improved_description = ''
-        full_description = (
-            f"CONTEXT: \n{improved_description}\n\n"
-            f"------------------------------\n"
-            f"ORIGINAL TG MESSAGE: \n{indented_message}\n"
-            f"------------------------------\n"
-            f"FORWARDED FROM: {forwarded_from_str}\n"
-            f"------------------------------"
-        )
-        task = asana_client.tasks.create_task({
-            'name': improved_title,
-            'notes': full_description,
-            'projects': [project_id]
-        })
-        # Upload all documents as attachments if present
-        documents = store.get('documents', [])
-        photos = store.get('photos', [])
-        attachment_results = []
-        for doc in documents:
+            input_file = await openai_client.files.create(file=('tasks.jsonl', lines), purpose='batch')
+            batch = await openai_client.batches.create(
+                input_file_id=input_file.id,
+                endpoint='/v1/chat/completions',
+                completion_window='24h'
+            )
+        except Exception as e:
+            logger.error("Failed to submit OpenAI batch, will retry: %s", e)
+        else:
+            del queued_tasks[:len(entries)]
+            ai_batches[batch.id] = {entry['custom_id']: entry for entry in entries}
+            logger.info("Submitted OpenAI batch %s with %s tasks", batch.id, len(entries))
+    for batch_id, entries in list(ai_batches.items()):
+        try:
+            batch = await openai_client.batches.retrieve(batch_id)
+        except Exception as e:
+            logger.error("Failed to poll OpenAI batch %s: %s", batch_id, e)
+            continue
+        if batch.status not in ('completed', 'failed', 'expired', 'cancelled'):
+            continue
+        output_text = ''
+        if batch.output_file_id:
             try:
-                tg_file = context.bot.get_file(doc['file_id'])
-                with tempfile.NamedTemporaryFile(delete=False, suffix=os.path.splitext(doc['file_name'])[1]) as tmp_file:
-                    tg_file.download(custom_path=tmp_file.name)
-                    tmp_file.flush()
-                    tmp_file.seek(0)
-                    with open(tmp_file.name, 'rb') as f:
-                        asana_client.attachments.create_on_task(task['gid'], file_content=f, file_name=doc['file_name'])
-                    attachment_results.append(doc['file_name'])
-                os.unlink(tmp_file.name)
+                output = await openai_client.files.content(batch.output_file_id)
             except Exception as e:
-                logger.error(f"Failed to upload document {doc['file_name']} to Asana: {e}")
-        # Handle photo attachments
-        for photo in photos:
+                # Keep the batch so the next poll retries; its tasks are already paid for
+                logger.error("Failed to download OpenAI batch %s output, will retry: %s", batch_id, e)
+                continue
+            output_text = output.text
+        del ai_batches[batch_id]
+        for line in output_text.splitlines():
+            # A bad line only loses its own task; unmatched entries are reported below
             try:
-                tg_file = context.bot.get_file(photo['file_id'])
-                with tempfile.NamedTemporaryFile(delete=False, suffix='.jpg') as tmp_file:
-                    tg_file.download(custom_path=tmp_file.name)
-                    tmp_file.flush()
-                    tmp_file.seek(0)
-                    with open(tmp_file.name, 'rb') as f:
-                        asana_client.attachments.create_on_task(task['gid'], file_content=f, file_name=photo['file_name'])
-                    attachment_results.append(photo['file_name'])
-                os.unlink(tmp_file.name)
+                result = orjson.loads(line)
+                custom_id = result['custom_id']
             except Exception as e:
-                logger.error(f"Failed to upload photo {photo['file_name']} to Asana: {e}")
-        task_url = f"https://app.asana.com/0/{project_id}/{task['gid']}"
-        query.edit_message_text(f"✅ Task created: {task_url}")
-        store['active'] = False
-        user_id = store.get('user_id')
-        if user_id in recent_prompts:
-            recent_prompts[user_id] = [pid for pid in recent_prompts[user_id] if pid != original_message_id]
-        del message_store[original_message_id]
-        logger.info(f"Task created and state cleaned for user {user_id}.")
+                logger.error("Unreadable line in OpenAI batch %s output: %s", batch_id, e)
+                continue
+            entry = entries.pop(custom_id, None)
+            if entry is None:
+                continue
+            store = entry['store']
+            try:
+                content = result['response']['body']['choices'][0]['message']['content']
+                ai_json = orjson.loads(strip_code_fence(content))
+                improved_title = ai_json.get('title', store.user_title)
+                improved_description = ai_json.get('description', '')
+                task_url = await create_asana_task(context.bot, store, entry['project_id'], improved_title, improved_description)
+            except Exception as e:
+                logger.error("Error creating queued task %s: %s", entry['custom_id'], e)
+                await report_batched_task(context.bot, entry, "❌ Error creating queued task. Please forward the messages again.")
+                continue
+            await report_batched_task(context.bot, entry, f"✅ Task created: {task_url}")
+        # Anything left had no successful result in the batch output
+        for entry in entries.values():
+            logger.error("OpenAI batch %s ended (%s) without a result for %s", batch_id, batch.status, entry['custom_id'])
+            await report_batched_task(context.bot, entry, "❌ Error creating queued task. Please forward the messages again.")
+
+# Telegram shows a chat action for about 5 seconds, so re-send it a bit sooner
+TYPING_REFRESH_INTERVAL = 4  # seconds
+
+async def keep_typing(bot, chat_id):
+    # Show "typing…" until cancelled, so the user doesn't re-click while we work
+    while True:
+        try:
+            await bot.send_chat_action(chat_id=chat_id, action=ChatAction.TYPING)
+        except Exception as e:
+            logger.warning("Error sending typing action: %s", e)
+        await asyncio.sleep(TYPING_REFRESH_INTERVAL)
+
+async def finish_task(bot, query, store, project_id, task_key, pending_tasks):
+    typing = asyncio.create_task(keep_typing(bot, query.message.chat_id))
+    try:
+        improved_title, improved_description = await improve_task_text(store.user_title, store.text)
+        task_url = await create_asana_task(bot, store, project_id, improved_title, improved_description)
+        await edit_query_message(query, f"✅ Task created: {task_url}")
+        await close_task_flow(store, task_key, pending_tasks, (query.message.chat_id, query.message.message_id))
+        logger.info("Task created and state cleaned for user %s.", store.user_id)
     except Exception as e:
-        logger.error(f"Error creating task: {e}")
+        logger.error("Error creating task: %s", e)
+        # Keep the project keyboard so the user can retry
+        store.state = 'awaiting_project'
         try:
-            query.edit_message_text("❌ Error creating task. Please try again later.")
+            await edit_query_message(query, "❌ Error creating task. Please try again later.", reply_markup=PROJECT_MARKUP)
         except Exception as edit_err:
             if "Message is not modified" in str(edit_err):
                 logger.warning("Tried to edit message with the same content. Ignoring.")
             else:
-                logger.error(f"Unexpected error editing message: {edit_err}")
-
-def main():
-    # Create and configure the updater
-    updater = Updater(os.getenv('TELEGRAM_BOT_TOKEN'))
-    dispatcher = updater.dispatcher
+                logger.error("Unexpected error editing message: %s", edit_err)
+    finally:
+        typing.cancel()
 
+async def post_init(application):
     # Set up bot commands
     commands = [
         ('start', 'Start the bot'),
         ('menu', 'Show the main menu'),
         ('help', 'Show help information')
     ]
-    updater.bot.set_my_commands(commands)
+    # set_my_commands is a network round-trip on every start; skip it when this
+    # bot's command list hasn't changed since it was last set
+    commands_hash = hashlib.sha256(repr((application.bot.id, commands)).encode()).hexdigest()
+    cache_path = pathlib.Path(os.getenv('COMMANDS_HASH_PATH', '/tmp/.tg_cmds'))
+    try:
+        cached_hash = cache_path.read_text()
+    except OSError:
+        cached_hash = None
+    if cached_hash == commands_hash:
+        return
+    await application.bot.set_my_commands(commands)
+    try:
+        cache_path.write_text(commands_hash)
+    except OSError as e:
+        logger.warning("Could not record bot commands hash at %s: %s", cache_path, e)
+
+async def post_shutdown(application):
+    await asana_http.aclose()
+
+# Upper bound on updates processed at once (PTB's default when enabled is 256)
+MAX_CONCURRENT_UPDATES = int(os.getenv('MAX_CONCURRENT_UPDATES', '256'))
+
+# The bot only handles messages and inline button presses; don't have Telegram
+# deliver edits, channel posts, member updates, etc.
+ALLOWED_UPDATES = [Update.MESSAGE, Update.CALLBACK_QUERY]
+
+def main():
+    # Create and configure the application
+    app = (
+        ApplicationBuilder()
+        .token(os.getenv('TELEGRAM_BOT_TOKEN'))
+        .concurrent_updates(MAX_CONCURRENT_UPDATES)
+        # Share HTTP/2 connections for all Bot API calls instead of a handshake per request
+        .request(HTTPXRequest(http_version="2", connection_pool_size=64, pool_timeout=10))
+        .get_updates_request(HTTPXRequest(http_version="2"))
+        # Queue outgoing calls within Telegram's flood limits and retry on RetryAfter
+        .rate_limiter(AIORateLimiter(max_retries=3))
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
+
+    # Periodically drop abandoned task flows
+    app.job_queue.run_repeating(sweep_stores, interval=STORE_SWEEP_INTERVAL, first=STORE_SWEEP_INTERVAL)
+
+    # Submit queued AI requests and collect finished Batch API results
+    app.job_queue.run_repeating(process_ai_batches, interval=AI_BATCH_POLL_INTERVAL, first=AI_BATCH_POLL_INTERVAL)
 
     # Add raw logger at the very top
-    dispatcher.add_handler(MessageHandler(Filters.all, log_all_messages), group=99)
+    app.add_handler(MessageHandler(filters.ALL, log_all_messages), group=99)
 
     # Add handlers in correct order
-    dispatcher.add_handler(CommandHandler("start", start))
-    dispatcher.add_handler(CommandHandler("help", help_command))
-    dispatcher.add_handler(CommandHandler("menu", menu))
-    # Forwarded message handlers FIRST
-    dispatcher.add_handler(MessageHandler(Filters.forwarded & (Filters.text | Filters.caption), handle_forwarded_message))
-    dispatcher.add_handler(MessageHandler(Filters.forwarded & Filters.document, handle_forwarded_message))
-    # Reply handler
-    dispatcher.add_handler(MessageHandler(Filters.reply, handle_title_reply))
-    # Standalone title and menu handlers
-    dispatcher.add_handler(MessageHandler(Filters.text & ~Filters.command, handle_title_standalone))
-    dispatcher.add_handler(MessageHandler(Filters.text & ~Filters.command, handle_menu_option))
-    dispatcher.add_handler(CallbackQueryHandler(button_callback))
+    app.add_handler(CommandHandler("start", start))
+    app.add_handler(CommandHandler("help", help_command))
+    app.add_handler(CommandHandler("menu", menu))
+    # Forwarded message handler FIRST; it sorts out text, captions, documents and photos itself
+    app.add_handler(MessageHandler(filters.FORWARDED, handle_forwarded_message))
+    # Menu, title reply and standalone title handler
+    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text))
+    app.add_handler(CallbackQueryHandler(button_callback))
 
     # Start the bot
     if os.getenv('HEROKU_APP_NAME'):  # If running on Heroku
         port = int(os.environ.get('PORT', 5000))
         public_url = os.getenv('HEROKU_PUBLIC_URL')
-        updater.start_webhook(
+        logger.info("Bot starting in webhook mode")
+        logger.warning("TELEGRAM_BOT_TOKEN: %s", os.getenv('TELEGRAM_BOT_TOKEN'))
+        logger.warning("HEROKU_APP_NAME: %s", os.getenv('HEROKU_APP_NAME'))
+        logger.warning("HEROKU_PUBLIC_URL: %s", public_url)
+        logger.warning("Listening on path: /%s", os.getenv('TELEGRAM_BOT_TOKEN'))
+        app.run_webhook(
             listen='0.0.0.0',
             port=port,
             url_path=os.getenv('TELEGRAM_BOT_TOKEN'),
-            webhook_url=f"https://{public_url}/{os.getenv('TELEGRAM_BOT_TOKEN')}"
+            webhook_url=f"https://{public_url}/{os.getenv('TELEGRAM_BOT_TOKEN')}",
+            allowed_updates=ALLOWED_UPDATES
         )
-        logger.info("Bot started in webhook mode")
-        logger.warning(f"TELEGRAM_BOT_TOKEN: {os.getenv('TELEGRAM_BOT_TOKEN')}")
-        logger.warning(f"HEROKU_APP_NAME: {os.getenv('HEROKU_APP_NAME')}")
-        logger.warning(f"HEROKU_PUBLIC_URL: {public_url}")
-        logger.warning(f"Listening on path: /{os.getenv('TELEGRAM_BOT_TOKEN')}")
     else:  # If running locally
-        updater.start_polling()
-        logger.info("Bot started in polling mode")
-
-    logger.warning("Bot entering idle mode")
-    updater.idle()
+        logger.info("Bot starting in polling mode")
+        # Long polling: each getUpdates call waits up to 30s for new updates
+        app.run_polling(poll_interval=0.0, timeout=30, allowed_updates=ALLOWED_UPDATES)
 
 if __name__ == '__main__':
     main() 
\ No newline at end of file